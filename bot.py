@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 import os
+import json
 import time
+import signal
+import queue
 import logging
+import logging.handlers
 import asyncio
 import httpx
-from functools import wraps
-from collections import defaultdict
-from typing import Optional
+from collections import deque
+from typing import Iterator, Optional
+
+from cachetools import LRUCache, TTLCache
 
 import google.generativeai as genai
 from telegram import (
@@ -23,6 +28,14 @@ from telegram.ext import (
     ContextTypes,
     CallbackContext
 )
+from telegram.request import HTTPXRequest
+from telegram.error import InvalidToken
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 from config import (
     BOT_TOKEN,
@@ -31,108 +44,253 @@ from config import (
     ADMIN_IDS,
     BOT_CONFIG,
     GEMINI_CONFIG,
-    LOGGING_CONFIG
+    LOGGING_CONFIG,
+    REDIS_URL
+)
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+# --- Precomputed Request Constants ---
+# These are pure functions of config and never change at runtime, so
+# build them once at import instead of on every message.
+genai.configure(api_key=GEMINI_API_KEY)
+GEMINI_GENERATE_URL = (
+    f"{GEMINI_CONFIG['base_url']}/{GEMINI_CONFIG['api_version']}"
+    f"/models/{GEMINI_CONFIG['model_name']}:generateContent"
+)
+GEMINI_STREAM_URL = (
+    f"{GEMINI_CONFIG['base_url']}/{GEMINI_CONFIG['api_version']}"
+    f"/models/{GEMINI_CONFIG['model_name']}:streamGenerateContent"
 )
+SAFETY_SETTINGS = [
+    {"category": category, "threshold": threshold}
+    for category, threshold in GEMINI_CONFIG["safety_settings"].items()
+]
+MAX_MSG_LEN = BOT_CONFIG["max_message_length"]
+# Already a frozenset of ints from config; aliased here so the
+# per-update check skips the BOT_CONFIG dict lookup
+BLOCKED_USERS = BOT_CONFIG["blocked_users"]
 
 # --- Enhanced Logging Setup ---
 logger = logging.getLogger(__name__)
 
-def setup_logging():
-    """Configure comprehensive logging"""
-    logging.basicConfig(
-        level=LOGGING_CONFIG["log_level"],
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(
-                filename=LOGGING_CONFIG["log_file"],
-                encoding='utf-8',
-                mode='a'
-            ),
-            logging.StreamHandler()
-        ]
+def setup_logging() -> logging.handlers.QueueListener:
+    """Configure comprehensive logging
+
+    Handlers run on a QueueListener background thread, so the event loop
+    only ever enqueues records and never blocks on a file write.
+    """
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler = logging.FileHandler(
+        filename=LOGGING_CONFIG["log_file"],
+        encoding='utf-8',
+        mode='a'
     )
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
+    )
+    listener.start()
+
+    root = logging.getLogger()
+    root.setLevel(LOGGING_CONFIG["log_level"])
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
     # Reduce noise from underlying libraries
     logging.getLogger("httpx").setLevel(logging.WARNING)
     logging.getLogger("httpcore").setLevel(logging.WARNING)
+    logging.getLogger("telegram.ext").setLevel(logging.WARNING)
+    return listener
 
-setup_logging()
+log_listener = setup_logging()
 
 # --- Connection Verification ---
-async def verify_telegram_connection():
-    """Verify we can connect to Telegram API"""
+# A bad Telegram token surfaces on PTB's own get_me during startup, so
+# there is no separate Telegram probe; only the Gemini key needs an
+# explicit check, and a metadata listing validates it without paying
+# for an inference call
+async def verify_gemini_connection():
+    """Verify the Gemini API key with a cheap metadata call"""
     try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            # Check basic API connectivity
-            response = await client.get(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/getMe"
-            )
-            if response.status_code != 200:
-                raise ConnectionError(
-                    f"Telegram API connection failed: {response.text}"
-                )
-            
-            # Verify bot privacy settings
-            privacy_response = await client.get(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/getChat?chat_id={OWNER_ID}"
-            )
-            if privacy_response.status_code != 200:
-                logger.warning("Could not verify privacy settings - ensure bot can message you")
-            
-            return True
-            
+        models = await asyncio.to_thread(lambda: list(genai.list_models()))
+        return bool(models)
     except Exception as e:
-        logger.error(f"Telegram connection verification failed: {e}")
+        logger.error("Gemini connection verification failed: %s", e)
         return False
 
-async def verify_gemini_connection():
-    """Verify we can connect to Gemini API"""
+# --- Conversation Management ---
+# Both per-user maps are bounded so a long-running bot cannot grow them
+# forever: conversations are evicted least-recently-used once
+# max_tracked_users is reached, and rate-limit counters expire on their
+# own since they are only meaningful for about a second.
+class UserConversationCache(LRUCache):
+    """LRUCache that also drops the evicted user's rate-limit counter"""
+    def popitem(self):
+        user_id, conversation = super().popitem()
+        user_windows.pop(user_id, None)
+        return user_id, conversation
+
+user_conversations = UserConversationCache(maxsize=BOT_CONFIG["max_tracked_users"])
+
+def get_conversation(user_id: int) -> deque:
+    """Fetch a user's conversation history, creating it if needed
+
+    The history is a deque with maxlen, so appending automatically drops
+    the oldest entry once the cap is reached — no trimming needed.
+    """
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel(GEMINI_CONFIG["model_name"])
-        response = await asyncio.to_thread(
-            model.generate_content,
-            "Test connection"
-        )
-        return bool(response.text)
-    except Exception as e:
-        logger.error(f"Gemini connection verification failed: {e}")
+        return user_conversations[user_id]
+    except KeyError:
+        conversation = deque(maxlen=BOT_CONFIG["conversation_history_size"])
+        user_conversations[user_id] = conversation
+        return conversation
+
+# Locks sharded by user id: with concurrent_updates enabled, a /clear
+# and an in-flight reply for the same user may run at once, and their
+# history mutations (local append plus Redis mirror) must not
+# interleave. Sixteen shards keep unrelated users from ever contending.
+STATE_LOCKS = [asyncio.Lock() for _ in range(16)]
+
+def user_state_lock(user_id: int) -> asyncio.Lock:
+    return STATE_LOCKS[user_id & 15]
+
+# Sliding-window rate-limit counters: user_id -> (prev_count, curr_count, window_start)
+# using 1-second windows. The previous window's count is weighted by how much of
+# it still overlaps the sliding window, so the check is O(1) arithmetic instead
+# of scanning a list of timestamps.
+user_windows = TTLCache(maxsize=BOT_CONFIG["max_tracked_users"], ttl=2)
+
+def check_rate_limit(user_id: int) -> bool:
+    """Record a message for user_id; return True if it is within the rate limit
+
+    Uses the monotonic clock: NTP stepping the wall clock must not make
+    windows expire early or never.
+    """
+    now = time.monotonic()
+    window = int(now)
+    prev_count, curr_count, window_start = user_windows.get(user_id, (0, 0, window))
+
+    if window != window_start:
+        # Slide: the old current window becomes the previous one if adjacent,
+        # otherwise both windows have fully expired
+        prev_count = curr_count if window == window_start + 1 else 0
+        curr_count = 0
+        window_start = window
+
+    # Weighted estimate of messages in the last second
+    estimated = prev_count * (1.0 - (now - window)) + curr_count
+    if estimated >= BOT_CONFIG["rate_limit_per_user"]:
+        user_windows[user_id] = (prev_count, curr_count, window_start)
+        logger.warning("Rate limit exceeded for user %s", user_id)
         return False
 
-# --- Conversation Management ---
-user_conversations = defaultdict(list)
-user_message_times = defaultdict(list)
-
-def rate_limit(func):
-    """Decorator to implement rate limiting"""
-    @wraps(func)
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user_id = update.effective_user.id
-        now = time.time()
-        
-        # Clear old timestamps
-        user_message_times[user_id] = [
-            t for t in user_message_times[user_id] 
-            if now - t < 1  # 1 second window
-        ]
-        
-        # Check rate limit
-        if len(user_message_times[user_id]) >= BOT_CONFIG["rate_limit_per_user"]:
-            await update.message.reply_text(
-                "🚫 You're sending messages too fast. Please wait a moment."
-            )
-            logger.warning(f"Rate limit exceeded for user {user_id}")
-            return
-        
-        user_message_times[user_id].append(now)
-        return await func(update, context)
-    return wrapper
+    user_windows[user_id] = (prev_count, curr_count + 1, window_start)
+    return True
+
+# --- Optional Redis Backend ---
+# When REDIS_URL is set, rate-limit state and conversation history are
+# also kept in Redis so they survive restarts and can be shared by
+# multiple bot workers behind a webhook; otherwise everything stays
+# in-process as before.
+redis_client = (
+    aioredis.from_url(REDIS_URL, decode_responses=True)
+    if REDIS_URL and aioredis is not None
+    else None
+)
+
+async def redis_check_rate_limit(user_id: int) -> bool:
+    """Shared sliding-window check against a per-user Redis ZSET
+
+    The three ZSET ops plus the EXPIRE run in one pipelined round-trip;
+    the key expiring keeps idle users from accumulating server-side.
+    """
+    now = time.time()
+    key = f"user:{user_id}:rl"
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.zremrangebyscore(key, "-inf", now - 1)
+        pipe.zadd(key, {str(now): now})
+        pipe.zcard(key)
+        pipe.expire(key, 60)
+        _, _, count, _ = await pipe.execute()
+    return count <= BOT_CONFIG["rate_limit_per_user"]
+
+async def redis_append_history(user_id: int, entry: dict):
+    """Mirror a history entry into a capped per-user Redis list"""
+    key = f"user:{user_id}:history"
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.rpush(key, json.dumps(entry))
+        pipe.ltrim(key, -BOT_CONFIG["conversation_history_size"], -1)
+        pipe.expire(key, 86400)
+        await pipe.execute()
+
+class SeenUpdates:
+    """Bounded duplicate filter over recent update ids
+
+    Telegram can redeliver the same update (webhook retries, reconnect
+    replays), and a duplicate would pay a full Gemini round-trip. Two
+    rotating sets of up to `capacity` ids each cover a sliding window of
+    at least the last `capacity` updates with bounded memory, and unlike
+    a Bloom filter pair never reject a fresh update by mistake.
+    """
+    def __init__(self, capacity: int = 5000):
+        self.capacity = capacity
+        self.current = set()
+        self.previous = set()
+
+    def seen(self, update_id: int) -> bool:
+        """Record update_id; return True if it was already in the window"""
+        if update_id in self.current or update_id in self.previous:
+            return True
+        self.current.add(update_id)
+        if len(self.current) >= self.capacity:
+            self.previous = self.current
+            self.current = set()
+        return False
+
+seen_updates = SeenUpdates()
+
+async def prune_rate_windows():
+    """Periodically drop expired rate-limit counters
+
+    TTLCache only evicts lazily on access, so counters for users who go
+    quiet would otherwise linger until the cache fills up.
+    """
+    while True:
+        await asyncio.sleep(60)
+        user_windows.expire()
+
+rate_window_sweeper = None
+
+def start_rate_window_sweep():
+    """Start the background sweep once; retry-loop rebuilds must not stack tasks"""
+    global rate_window_sweeper
+    if rate_window_sweeper is None or rate_window_sweeper.done():
+        rate_window_sweeper = asyncio.create_task(prune_rate_windows())
+
+class RateLimitFilter(filters.MessageFilter):
+    """Drop over-limit messages inside PTB's filter pass
+
+    Running the check as a filter means rejected updates never construct
+    the handler coroutine or touch any per-user state downstream.
+    """
+    def filter(self, message) -> bool:
+        return message.from_user is None or check_rate_limit(message.from_user.id)
+
+rate_limit_filter = RateLimitFilter()
 
 async def generate_gemini_response(prompt: str) -> Optional[str]:
     """Generate response using Gemini 2.0 Flash API"""
     try:
         async with httpx.AsyncClient(timeout=GEMINI_CONFIG["timeout"]) as client:
             response = await client.post(
-                f"{GEMINI_CONFIG['base_url']}/{GEMINI_CONFIG['api_version']}/models/{GEMINI_CONFIG['model_name']}:generateContent",
+                GEMINI_GENERATE_URL,
                 params={"key": GEMINI_API_KEY},
                 json={
                     "contents": [{
@@ -140,68 +298,111 @@ async def generate_gemini_response(prompt: str) -> Optional[str]:
                             "text": prompt
                         }]
                     }],
-                    "safetySettings": [
-                        {
-                            "category": category,
-                            "threshold": threshold
-                        } for category, threshold in GEMINI_CONFIG["safety_settings"].items()
-                    ]
+                    "safetySettings": SAFETY_SETTINGS
                 },
                 headers={"Content-Type": "application/json"}
             )
             
             response.raise_for_status()
-            return response.json()["candidates"][0]["content"]["parts"][0]["text"]
+            return json_loads(response.content)["candidates"][0]["content"]["parts"][0]["text"]
             
     except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP error {e.response.status_code}: {e.response.text}")
+        logger.error("HTTP error %s: %s", e.response.status_code, e.response.text)
     except Exception as e:
-        logger.error(f"Generation error: {str(e)}")
+        logger.error("Generation error: %s", e)
     return None
 
+async def stream_gemini_response(prompt: str):
+    """Yield Gemini response text chunk by chunk as it is generated"""
+    async with httpx.AsyncClient(timeout=GEMINI_CONFIG["timeout"]) as client:
+        async with client.stream(
+            "POST",
+            GEMINI_STREAM_URL,
+            params={"key": GEMINI_API_KEY, "alt": "sse"},
+            json={
+                "contents": [{
+                    "parts": [{
+                        "text": prompt
+                    }]
+                }],
+                "safetySettings": SAFETY_SETTINGS
+            },
+            headers={"Content-Type": "application/json"}
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                payload = json_loads(line[len("data: "):])
+                try:
+                    yield payload["candidates"][0]["content"]["parts"][0]["text"]
+                except (KeyError, IndexError):
+                    continue
+
 # --- Utility Functions ---
 def is_admin(user_id: int) -> bool:
     """Check if user is admin"""
     return user_id in ADMIN_IDS
 
+def split_message(text: str) -> Iterator[str]:
+    """Yield Telegram-sized chunks of text, cutting on whitespace where possible"""
+    start = 0
+    while len(text) - start > MAX_MSG_LEN:
+        cut = text.rfind(' ', start + 1, start + MAX_MSG_LEN + 1)
+        if cut == -1:
+            # No whitespace in the window; fall back to a hard cut
+            cut = start + MAX_MSG_LEN
+            yield text[start:cut]
+            start = cut
+        else:
+            yield text[start:cut]
+            start = cut + 1  # drop the boundary space
+    # A trailing boundary space can leave nothing behind, and Telegram
+    # rejects empty messages
+    if start < len(text):
+        yield text[start:]
+
 async def send_long_message(update: Update, text: str):
     """Split long messages to fit Telegram's limits"""
-    max_len = BOT_CONFIG["max_message_length"]
-    for i in range(0, len(text), max_len):
-        await update.message.reply_text(text[i:i+max_len])
+    chunks = split_message(text)
+    if update.effective_chat.type == "private":
+        # DMs don't need strict ordering, so pipeline the HTTPS requests
+        await asyncio.gather(*(update.message.reply_text(chunk) for chunk in chunks))
+    else:
+        for chunk in chunks:
+            await update.message.reply_text(chunk)
 
 async def log_update(update: Update):
     """Log details about incoming updates"""
+    if not BOT_CONFIG["verbose_update_logging"]:
+        return
+    if not logger.isEnabledFor(logging.INFO):
+        return
     logger.info(
-        f"New update [ID:{update.update_id}]: "
-        f"User:{update.effective_user.id if update.effective_user else None} "
-        f"Chat:{update.effective_chat.id if update.effective_chat else None} "
-        f"Type:{update.effective_message.content_type if update.effective_message else None}"
+        "New update [ID:%s]: User:%s Chat:%s Type:%s",
+        update.update_id,
+        update.effective_user.id if update.effective_user else None,
+        update.effective_chat.id if update.effective_chat else None,
+        update.effective_message.content_type if update.effective_message else None
     )
 
 # --- Command Handlers ---
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /start command"""
-    await log_update(update)
-    
-    user = update.effective_user
-    if str(user.id) in BOT_CONFIG["blocked_users"]:
-        await update.message.reply_text("🚫 You are blocked from using this bot.")
-        return
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("🌐 Network", url=BOT_CONFIG["network_url"]),
-            InlineKeyboardButton("🆘 Support", url=BOT_CONFIG["support_url"]),
-        ],
-        [
-            InlineKeyboardButton("🌐 Website", url=BOT_CONFIG["website_url"]),
-            InlineKeyboardButton("📜 Commands", callback_data="help")
-        ]
+# Static reply content built once at import: the keyboard markup is
+# immutable and reusable across users, and only the mention varies in
+# the welcome message
+START_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🌐 Network", url=BOT_CONFIG["network_url"]),
+        InlineKeyboardButton("🆘 Support", url=BOT_CONFIG["support_url"]),
+    ],
+    [
+        InlineKeyboardButton("🌐 Website", url=BOT_CONFIG["website_url"]),
+        InlineKeyboardButton("📜 Commands", callback_data="help")
     ]
-    
-    welcome_message = f"""
-👋 Hello {user.mention_html()}!
+])
+
+WELCOME_TEMPLATE = """
+👋 Hello {mention}!
 
 I'm an advanced AI chatbot powered by Google Gemini. Here's what I can do:
 
@@ -214,18 +415,8 @@ I'm an advanced AI chatbot powered by Google Gemini. Here's what I can do:
 📌 Use /help to see all available commands.
 🔍 Just send me a message to start chatting!
 """
-    
-    await update.message.reply_html(
-        welcome_message,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        disable_web_page_preview=True
-    )
-    logger.info(f"Welcomed user {user.id} - {user.full_name}")
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /help command"""
-    await log_update(update)
-    help_text = """
+HELP_TEXT = """
 <b>🤖 Bot Commands:</b>
 
 /start - Start the bot
@@ -246,14 +437,36 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /block - Block a user
 /unblock - Unblock a user
 """
-    await update.message.reply_html(help_text)
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /start command"""
+    await log_update(update)
+
+    user = update.effective_user
+    if user.id in BLOCKED_USERS:
+        await update.message.reply_text("🚫 You are blocked from using this bot.")
+        return
+
+    await update.message.reply_html(
+        WELCOME_TEMPLATE.format(mention=user.mention_html()),
+        reply_markup=START_KEYBOARD,
+        disable_web_page_preview=True
+    )
+    logger.info("Welcomed user %s - %s", user.id, user.full_name)
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /help command"""
+    await log_update(update)
+    await update.message.reply_html(HELP_TEXT)
 
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /ping command"""
     await log_update(update)
-    start_time = time.time()
+    # Monotonic clock: this is an elapsed-time measurement, so it must
+    # not be skewed by wall-clock adjustments
+    start_time = time.monotonic()
     message = await update.message.reply_text("🏓 Pong!")
-    end_time = time.time()
+    end_time = time.monotonic()
     latency = round((end_time - start_time) * 1000, 2)
     
     await message.edit_text(
@@ -263,62 +476,136 @@ async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"💬 Active Users: {len(user_conversations)}"
     )
 
-@rate_limit
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# --- Per-Chat Work Queues ---
+# The PTB dispatcher only enqueues updates; a worker task per active chat
+# drains its queue serially. Per-chat ordering is preserved, but a slow
+# Gemini call in one chat no longer delays delivery to every other chat.
+chat_queues = {}
+chat_workers = {}
+CHAT_WORKER_IDLE_TIMEOUT = 60  # seconds before an idle worker exits
+
+async def _chat_worker(chat_id: int, work_queue: asyncio.Queue):
+    """Process queued updates for one chat until the queue stays idle"""
+    try:
+        while True:
+            try:
+                update, context = await asyncio.wait_for(
+                    work_queue.get(), timeout=CHAT_WORKER_IDLE_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                if work_queue.empty():
+                    break
+                continue
+            try:
+                await _process_message(update, context)
+            except Exception as e:
+                logger.error("Worker error in chat %s: %s", chat_id, e, exc_info=True)
+    finally:
+        chat_queues.pop(chat_id, None)
+        chat_workers.pop(chat_id, None)
+
+async def _process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_message = update.message.text
-    
+
     try:
-        logger.info(f"Processing message with Gemini 2.0 Flash: {user_message[:100]}...")
-        response = await generate_gemini_response(user_message)
-        
-        if response:
-            await send_long_message(update, response)
-            # Store in conversation history
-            user_conversations[update.effective_user.id].append({
-                "role": "assistant",
-                "content": response
-            })
-        else:
+        logger.info("Processing message with Gemini 2.0 Flash: %.100s...", user_message)
+        history = get_conversation(update.effective_user.id)
+
+        # Stream the response: flush a Telegram message whenever a full
+        # chunk is ready, so the first part ships while Gemini is still
+        # generating the tail
+        buffer = ""
+        sent_any = False
+        async for chunk in stream_gemini_response(user_message):
+            buffer += chunk
+            while len(buffer) >= MAX_MSG_LEN:
+                # Prefer a whitespace boundary, like split_message does
+                cut = buffer.rfind(' ', 1, MAX_MSG_LEN + 1)
+                if cut == -1:
+                    part, buffer = buffer[:MAX_MSG_LEN], buffer[MAX_MSG_LEN:]
+                else:
+                    part, buffer = buffer[:cut], buffer[cut + 1:]
+                await update.message.reply_text(part)
+                entry = {"role": "assistant", "content": part}
+                async with user_state_lock(update.effective_user.id):
+                    history.append(entry)
+                    if redis_client is not None:
+                        await redis_append_history(update.effective_user.id, entry)
+                sent_any = True
+
+        if buffer:
+            await send_long_message(update, buffer)
+            entry = {"role": "assistant", "content": buffer}
+            async with user_state_lock(update.effective_user.id):
+                history.append(entry)
+                if redis_client is not None:
+                    await redis_append_history(update.effective_user.id, entry)
+            sent_any = True
+
+        if not sent_any:
             await update.message.reply_text("⚠️ Could not generate response. The AI service might be busy.")
-            
+
     except Exception as e:
-        logger.error(f"Message handling failed: {str(e)}")
+        logger.error("Message handling failed: %s", e)
         await update.message.reply_text("🚨 An error occurred. Please try again later.")
-        
-        # Send response
-        await send_long_message(update, response.text)
-        
-        # Store bot response in history
-        user_conversations[user.id].append({"role": "assistant", "content": response.text})
-        
-    except Exception as e:
-        logger.error(f"Error processing message: {str(e)}", exc_info=True)
-        await update.message.reply_text(
-            "⚠️ An error occurred while processing your message. Please try again later."
-        )
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Hand the update to its chat's worker; returns without awaiting Gemini"""
+    if seen_updates.seen(update.update_id):
+        logger.info("Skipping duplicate update %s", update.update_id)
+        return
+
+    # The in-memory filter has already passed; when Redis is configured,
+    # also enforce the limit shared across workers
+    if redis_client is not None:
+        try:
+            if not await redis_check_rate_limit(update.effective_user.id):
+                logger.warning("Shared rate limit exceeded for user %s", update.effective_user.id)
+                return
+        except Exception as e:
+            logger.error("Redis rate-limit check failed: %s", e)
+
+    chat_id = update.effective_chat.id
+    work_queue = chat_queues.get(chat_id)
+    if work_queue is None:
+        work_queue = chat_queues[chat_id] = asyncio.Queue()
+        chat_workers[chat_id] = asyncio.create_task(_chat_worker(chat_id, work_queue))
+    work_queue.put_nowait((update, context))
 
 # --- Admin Commands ---
+STATS_TEMPLATE = """
+<b>📊 Bot Statistics</b>
+
+👥 Total Users: %d
+💬 Active Conversations: %d
+🔄 Rate Limited Users: %d
+"""
+
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /stats command"""
     await log_update(update)
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("🚫 This command is only available for admins.")
         return
-    
-    stats_text = f"""
-<b>📊 Bot Statistics</b>
 
-👥 Total Users: {len(user_conversations)}
-💬 Active Conversations: {sum(1 for conv in user_conversations.values() if len(conv) > 0)}
-🔄 Rate Limited Users: {sum(1 for times in user_message_times.values() if len(times) >= BOT_CONFIG["rate_limit_per_user"])}
-"""
+    limit = BOT_CONFIG["rate_limit_per_user"]
+    stats_text = STATS_TEMPLATE % (
+        len(user_conversations),
+        sum(1 for conv in user_conversations.values() if conv),
+        sum(1 for prev, curr, _ in user_windows.values() if prev + curr >= limit)
+    )
     await update.message.reply_html(stats_text)
 
 async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /clear command"""
     await log_update(update)
     user_id = update.effective_user.id
-    user_conversations[user_id] = []
+    # pop rather than get_conversation().clear(): clearing a user who has
+    # no history must not insert an empty entry for them
+    async with user_state_lock(user_id):
+        user_conversations.pop(user_id, None)
+        if redis_client is not None:
+            await redis_client.delete(f"user:{user_id}:history")
     await update.message.reply_text("🗑️ Your conversation history has been cleared.")
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -333,15 +620,27 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     message = " ".join(context.args)
-    broadcast_count = 0
-    
-    for user_id in user_conversations.keys():
+
+    async def send_to_user(user_id: int) -> int:
         try:
             await context.bot.send_message(user_id, f"📢 Broadcast:\n\n{message}")
-            broadcast_count += 1
+            return 1
         except Exception as e:
-            logger.error(f"Failed to send broadcast to {user_id}: {str(e)}")
-    
+            logger.error("Failed to send broadcast to %s: %s", user_id, e)
+            return 0
+
+    # Snapshot the keys so cache eviction during the sends can't break
+    # iteration, then fan out one 30-message batch per second — the
+    # documented global send ceiling for a bot
+    user_ids = list(user_conversations.keys())
+    broadcast_count = 0
+    for i in range(0, len(user_ids), 30):
+        batch = user_ids[i:i + 30]
+        results = await asyncio.gather(*(send_to_user(user_id) for user_id in batch))
+        broadcast_count += sum(results)
+        if i + 30 < len(user_ids):
+            await asyncio.sleep(1.0)
+
     await update.message.reply_text(f"📢 Broadcast sent to {broadcast_count} users.")
 
 async def verify_api(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -362,6 +661,9 @@ async def post_init(application: Application):
     try:
         # Clear any existing webhook
         await application.bot.delete_webhook()
+
+        # Background sweep for idle rate-limit state
+        start_rate_window_sweep()
         
         # Set bot commands
         await application.bot.set_my_commands([
@@ -379,12 +681,14 @@ async def post_init(application: Application):
                  f"🖥️ Host: {os.uname().nodename}"
         )
     except Exception as e:
-        logger.error(f"Startup initialization failed: {e}")
+        logger.error("Startup initialization failed: %s", e)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors in the bot"""
     logger.error(
-        f"Error in update {update.update_id if update else None}: {context.error}",
+        "Error in update %s: %s",
+        update.update_id if update else None,
+        context.error,
         exc_info=True
     )
     
@@ -402,14 +706,29 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         pass
 
+class FastJSONRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Telegram payloads with orjson when installed"""
+    def parse_json_payload(self, payload: bytes) -> dict:
+        return json_loads(payload)
+
 def create_application():
     """Create and configure the Telegram application"""
+    # A sized pool lets concurrent handler sends actually run in
+    # parallel instead of serializing on the default single connection;
+    # HTTP/2 multiplexes the logical streams over a few TCP connections
+    request = FastJSONRequest(
+        connection_pool_size=256,
+        http_version="2",
+        connect_timeout=30,
+        read_timeout=30,
+        write_timeout=30,
+        pool_timeout=30
+    )
     return Application.builder() \
         .token(BOT_TOKEN) \
-        .connect_timeout(30) \
-        .read_timeout(30) \
-        .write_timeout(30) \
-        .pool_timeout(30) \
+        .request(request) \
+        .get_updates_request(FastJSONRequest(connection_pool_size=8)) \
+        .concurrent_updates(True) \
         .post_init(post_init) \
         .build()
 
@@ -426,56 +745,116 @@ def setup_handlers(application):
     
     # Message handler
     application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND,
+        filters.TEXT & ~filters.COMMAND & rate_limit_filter,
         handle_message
     ))
     
     # Error handler
     application.add_error_handler(error_handler)
 
+async def teardown_application(application: Application):
+    """Best-effort teardown that tolerates a partially started application
+
+    Each stage is stopped independently: a failed updater stop (e.g. the
+    updater was never started) must not prevent stop()/shutdown() from
+    running.
+    """
+    if application is None:
+        return
+    try:
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+    except Exception as e:
+        logger.error("Updater stop failed: %s", e)
+    try:
+        if application.running:
+            await application.stop()
+    except Exception as e:
+        logger.error("Application stop failed: %s", e)
+    try:
+        await application.shutdown()
+    except Exception as e:
+        logger.error("Application shutdown failed: %s", e)
+
 async def run_bot():
     """Main bot running function with enhanced reliability"""
     retry_count = 0
     max_retries = 5
-    
+
+    shutdown_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, shutdown_event.set)
+        except NotImplementedError:
+            pass  # signal handlers are not available on this platform
+
+    application = None
+    running = False
     while retry_count < max_retries:
         try:
-            # Verify connections before starting
-            if not all([
-                await verify_telegram_connection(),
-                await verify_gemini_connection()
-            ]):
+            # Verify the Gemini key before starting (optional, skippable
+            # deployments save the startup round-trip)
+            if BOT_CONFIG["verify_connections"] and not await verify_gemini_connection():
                 raise ConnectionError("Connection verification failed")
-            
-            # Initialize application
-            application = create_application()
-            setup_handlers(application)
-            
-            await application.initialize()
-            await application.start()
-            
+
+            # Reuse the application only once it has fully reached the
+            # running state; a startup failure leaves it half-built, so
+            # rebuild from scratch in that case
+            if not running:
+                application = create_application()
+                setup_handlers(application)
+                await application.initialize()
+                # PTB only invokes post_init from run_polling/run_webhook,
+                # so this manual bootstrap must call it itself — it hooks
+                # in the rate-window sweep, command list, and startup
+                # notification
+                await post_init(application)
+                await application.start()
+
+                # Webhook mode skips the getUpdates round-trip per batch:
+                # Telegram pushes updates to us as they happen
+                if BOT_CONFIG["webhook_url"]:
+                    await application.updater.start_webhook(
+                        listen="0.0.0.0",
+                        port=BOT_CONFIG["webhook_port"],
+                        url_path=BOT_TOKEN,
+                        webhook_url=f"{BOT_CONFIG['webhook_url'].rstrip('/')}/{BOT_TOKEN}"
+                    )
+                else:
+                    await application.updater.start_polling()
+                running = True
+
             logger.info("Bot is now running and processing updates...")
-            
-            # Keep the application running
-            while True:
-                await asyncio.sleep(1)
-                
+
+            # Suspend until a shutdown signal arrives — no periodic wakeups
+            await shutdown_event.wait()
+            logger.info("Shutdown signal received")
+            break
+
+        except InvalidToken:
+            logger.critical("Bot token rejected by Telegram - not retrying")
+            break
         except Exception as e:
             retry_count += 1
-            logger.error(f"Bot crashed (attempt {retry_count}/{max_retries}): {e}")
-            
+            backoff = min(0.5 * 2 ** (retry_count - 1), 10)
+            logger.error("Bot crashed (attempt %s/%s): %s", retry_count, max_retries, e)
+
+            if not running:
+                # Never got off the ground this attempt: tear down the
+                # partial application before the next build
+                await teardown_application(application)
+                application = None
+
             if retry_count < max_retries:
-                logger.info("Restarting in 10 seconds...")
-                await asyncio.sleep(10)
+                logger.info("Retrying in %.1f seconds...", backoff)
+                await asyncio.sleep(backoff)
             else:
                 logger.critical("Maximum restart attempts reached")
-                break
-        finally:
-            try:
-                await application.stop()
-                await application.shutdown()
-            except:
-                pass
+
+    await teardown_application(application)
+    if rate_window_sweeper is not None:
+        rate_window_sweeper.cancel()
 
 def main():
     """Entry point for the bot"""
@@ -485,9 +864,10 @@ def main():
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
     except Exception as e:
-        logger.critical(f"Fatal error: {e}")
+        logger.critical("Fatal error: %s", e)
     finally:
         logger.info("Bot shutdown complete")
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
@@ -7,9 +7,12 @@ load_dotenv()
 
 # Telegram Bot Configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Optional: point at a Redis instance to share rate-limit/history state
+# across restarts and multiple workers
+REDIS_URL = os.getenv("REDIS_URL")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 OWNER_ID = int(os.getenv("OWNER_ID", "7448520005"))
-ADMIN_IDS = [int(id) for id in os.getenv("ADMIN_IDS", "7448520005,123456789").split(",") if id]
+ADMIN_IDS = frozenset(int(id) for id in os.getenv("ADMIN_IDS", "7448520005,123456789").split(",") if id)
 
 # Bot Configuration
 BOT_CONFIG = {
@@ -20,8 +23,14 @@ BOT_CONFIG = {
     "max_message_length": 4000,
     "rate_limit_per_user": 5,
     "conversation_history_size": 10,
+    "max_tracked_users": 10000,
     "allowed_chats": [chat for chat in os.getenv("ALLOWED_CHATS", "").split(",") if chat],
-    "blocked_users": [user for user in os.getenv("BLOCKED_USERS", "").split(",") if user],
+    "blocked_users": frozenset(int(user) for user in os.getenv("BLOCKED_USERS", "").split(",") if user),
+    "verify_connections": os.getenv("VERIFY_CONNECTIONS", "true").lower() == "true",
+    # Leave webhook_url empty to use long polling
+    "webhook_url": os.getenv("WEBHOOK_URL", ""),
+    "webhook_port": int(os.getenv("WEBHOOK_PORT", "8443")),
+    "verbose_update_logging": os.getenv("VERBOSE_UPDATE_LOGGING", "true").lower() == "true",
 }
 
 # Gemini Configuration